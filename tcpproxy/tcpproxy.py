@@ -1,32 +1,110 @@
 #!/usr/bin/env python3
 
 import os
+import errno
 import sys
-import argparse
 import socket
+import selectors
+import struct
 
 from   time import sleep, time
-from   subprocess import Popen, PIPE
+from   collections import deque
+from   itertools import islice
 from   threading import Thread
+from   concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    # The config file is read and written with the slower json based p3lib functions.
+    orjson = None
+
+# On Linux accept4() returns accepted sockets that are already non blocking and close on exec.
+try:
+    import ctypes
+    _accept4 = ctypes.CDLL(None, use_errno=True).accept4
+    _accept4.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int)
+    _accept4.restype = ctypes.c_int
+    if not hasattr(socket, "SOCK_NONBLOCK"):
+        _accept4 = None
+except (ImportError, OSError, AttributeError, TypeError):
+    _accept4 = None
 
 from   p3lib.uio import UIO
 from   p3lib.helper import logTraceBack, getHomePath, saveDict, getDict
-from   p3lib.boot_manager import BootManager
 
 class ProxyConfig(object):
     """@brief Responsible for managing the persistent proxy configuration."""
     
     CONFIG_FILE = os.path.join( getHomePath(), ".tcpproxy.cfg" )
     BIND_ALL_ADDRESS = "0.0.0.0/32"
+    NET_ADDR_CACHE_SECONDS = 5
+    SOCK_ADDR_CACHE_SECONDS = 60
+    # The parsed config file contents keyed by file name. Each value is a (mtime, row list) tuple.
+    _configCache = {}
     
     def __init__(self, uio):
         """@brief Constructor
            @param uio A UIO instance handling user input and output (E.G stdin/stdout or a GUI)."""
         self._uio = uio
+        self._sockAddrCache = {}
+        self._netAddrCache = None
+        self._singleProxyList = self._load()
+
+    def _load(self):
+        """@brief Load the config file. The parsed file is cached while its modification
+                  time is unchanged so that it is only parsed once per process.
+           @return A list of proxy configuration rows."""
         try:
-            self._singleProxyList = getDict(ProxyConfig.CONFIG_FILE, jsonFmt=True)
+            mtime = os.stat(ProxyConfig.CONFIG_FILE).st_mtime_ns
+        except OSError:
+            return []
+
+        cacheEntry = ProxyConfig._configCache.get(ProxyConfig.CONFIG_FILE)
+        if cacheEntry and cacheEntry[0] == mtime:
+            return list(cacheEntry[1])
+
+        try:
+            if orjson:
+                with open(ProxyConfig.CONFIG_FILE, 'rb') as fd:
+                    rowList = orjson.loads(fd.read())
+            else:
+                rowList = getDict(ProxyConfig.CONFIG_FILE, jsonFmt=True)
         except:
-            self._singleProxyList = []
+            rowList = []
+        if not isinstance(rowList, list):
+            rowList = []
+
+        singleProxyList = []
+        for attrList in rowList:
+            try:
+                singleProxyList.append(self._normaliseAttrList(attrList))
+            except (AttributeError, ValueError, TypeError, IndexError):
+                self._error("Ignoring invalid proxy configuration {} in {}".format(attrList, ProxyConfig.CONFIG_FILE))
+        ProxyConfig._configCache[ProxyConfig.CONFIG_FILE] = (mtime, singleProxyList)
+        return list(singleProxyList)
+
+    def _normaliseAttrList(self, attrList):
+        """@brief Remove any /subnet mask size from the addresses of a proxy configuration row.
+           @param attrList The bind address, listen port, destination address and destination port.
+           @return A tuple containing the same attributes as they are used by the proxy server."""
+        return (attrList[0].split("/")[0], int(attrList[1]), attrList[2].split("/")[0], int(attrList[3]))
+
+    def getSockAddr(self, address, port):
+        """@brief Get the socket address to connect to. The result is cached for
+                  SOCK_ADDR_CACHE_SECONDS so that name lookups are not performed for every
+                  proxied connection while a destination whose address changes is still followed.
+           @param address The host name or IP address.
+           @param port The TCP port.
+           @return The socket address tuple."""
+        key = (address, port)
+        cacheEntry = self._sockAddrCache.get(key)
+        if cacheEntry and time() - cacheEntry[0] < ProxyConfig.SOCK_ADDR_CACHE_SECONDS:
+            return cacheEntry[1]
+
+        sockAddr = socket.getaddrinfo(address, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        self._sockAddrCache[key] = (time(), sockAddr)
+        return sockAddr
 
     def _debug(self, msg):
         self._uio.debug(msg)
@@ -37,49 +115,27 @@ class ProxyConfig(object):
     def _error(self, msg):
         self._uio.error(msg)
 
-    def _isDebugEnabled(self):
-        """@brief Determinme if debugging is enabled.
-           @return True if debugging is enabled."""
-        return self._uio.isDebugEnabled()
-
-    def runCmd(self, cmd):
-        """@brief Run a system command.
-           @param The command to execute.
-           @return A tuple containing
-                   0: return code
-                   1: A list of stdout lines of text
-                   2: A list of stderr lines of text"""
-        self._debug("cmd: {}".format(cmd))
-        if not isinstance(cmd, list):
-            cmd = cmd.split()
-        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        out, err = proc.communicate()
-        stdOutLines = out.decode("utf-8").split("\n")
-        stdErrLines = err.decode("utf-8").split("\n")
-        if self._isDebugEnabled():
-            for l in stdOutLines:
-                self._debug("stdout: {}".format(l))
-            for l in stdErrLines:
-                self._debug("stderr: {}".format(l))
-        return (proc.returncode, stdOutLines, stdErrLines)
-
     def _getNetAddrList(self):
         """@brief Get the list of network interface addresses on the computer.
+                  The list is cached for NET_ADDR_CACHE_SECONDS as interfaces rarely change.
            @return A list of network interface addresses on the local computer.
                    Each IP address will include /subnet mask size."""
-        cmd = "/sbin/ip a"
-        rc, lines, _ = self.runCmd(cmd)
-        if rc:
-            raise Exception("{} command returned an error.".format(cmd))
+        if self._netAddrCache and time() - self._netAddrCache[0] < ProxyConfig.NET_ADDR_CACHE_SECONDS:
+            return self._netAddrCache[1]
+
+        # Only needed by the configuration dialog so not imported when serving.
+        import ipaddress
+        import psutil
+
         interfaceList = []
-        for line in lines:
-            line=line.strip()
-            elems = line.split()
-            if len(elems) > 0 and elems[0] == 'inet':
-                if len(elems) > 1:
-                    interfaceList.append(elems[1])
+        for addrList in psutil.net_if_addrs().values():
+            for addr in addrList:
+                if addr.family == socket.AF_INET:
+                    prefixLen = ipaddress.IPv4Network("0.0.0.0/{}".format(addr.netmask or "255.255.255.255")).prefixlen
+                    interfaceList.append("{}/{}".format(addr.address, prefixLen))
 
         interfaceList.append(ProxyConfig.BIND_ALL_ADDRESS)
+        self._netAddrCache = (time(), interfaceList)
         return interfaceList
 
     def _showProxyDict(self):
@@ -91,17 +147,11 @@ class ProxyConfig(object):
         col4Title = "Destination Port"
         titleHeaderLine = "| {: <3} | {: <12} | {: <11} | {: <19} | {: <16} |".format(col0Title, col1Title, col2Title, col3Title, col4Title)
         horSepLine = "*"*len(titleHeaderLine)
-        self._info(horSepLine)
-        self._info(titleHeaderLine)
-        self._info(horSepLine)
-        
-        id = 1
-        for attrList in self._singleProxyList:
-            rowLine = "| {: <3} | {: <12} | {: <11} | {: <19} | {: <16} !".format(id, attrList[0], attrList[1], attrList[2], attrList[3])
-            self._info(rowLine)
-            id = id + 1
-            
-        self._info(horSepLine)
+        lines = [horSepLine, titleHeaderLine, horSepLine]
+        lines.extend("| {: <3} | {: <12} | {: <11} | {: <19} | {: <16} !".format(id, *attrList) for id, attrList in enumerate(self._singleProxyList, 1))
+        lines.append(horSepLine)
+        # Start the table on a new line so that it stays aligned whatever prefix the UIO adds.
+        self._info("\n" + "\n".join(lines))
 
     def _getAddress(self, prompt, defaultAddress):
         """@brief Allow the user to enter an address.
@@ -123,8 +173,10 @@ class ProxyConfig(object):
         """@brief Get the local interface IP to bind to.
            @param defaultAddress The default IP address."""
         localBindAddress = None
+        netAddrList = self._getNetAddrList()
+        # Configured addresses are stored without the /subnet mask size so only compare the address.
+        netAddrSet = {netAddr.split("/")[0] for netAddr in netAddrList}
         while True:
-            netAddrList = self._getNetAddrList()
             self._uio.info("Local network interface address list")
             for netAddr in netAddrList:
                 self._uio.info(netAddr)
@@ -133,7 +185,7 @@ class ProxyConfig(object):
             if response is None:
                 return None
 
-            elif response in netAddrList:
+            elif response.split("/")[0] in netAddrSet:
                 localBindAddress = response
                 break
 
@@ -165,11 +217,13 @@ class ProxyConfig(object):
     def _addProxy(self):
         """@brief Add to the proxy configuration."""
         localBindAddress = self._getLocalBindAddress()
+        if localBindAddress is None:
+            return
         listenPort = self._getPort("Enter the local listen port")
         destAddr = self._uio.getInput("Enter the destination address")
         destPort = self._getPort("Enter the destination port")
         attrList = (localBindAddress, listenPort, destAddr, destPort)
-        self._singleProxyList.append(attrList)
+        self._singleProxyList.append(self._normaliseAttrList(attrList))
        
     def _editProxy(self):
         """@brief Edit to the proxy configuration."""
@@ -181,11 +235,13 @@ class ProxyConfig(object):
             destAddress = row[2]
             destPort = row[3]
             bindAddress = self._getLocalBindAddress(defaultAddress=bindAddress)
+            if bindAddress is None:
+                return
                        
             listenPort = self._getPort("Enter the local listen port (Enter={})".format(listenPort), defaultPort=listenPort)
             self._getAddress("Enter the destination address (Enter={})".format(destAddress), defaultAddress=destAddress )
             destPort = self._getPort("Enter the destination port (Enter={})".format(destPort), defaultPort=destPort)
-            self._singleProxyList[id-1] = [bindAddress, listenPort, destAddress, destPort]
+            self._singleProxyList[id-1] = self._normaliseAttrList((bindAddress, listenPort, destAddress, destPort))
 
     def _deleteProxy(self):
         """@brief Delete to the proxy configuration."""
@@ -196,7 +252,12 @@ class ProxyConfig(object):
 
     def _save(self):
         """@brief Save the config to the default config file."""
-        saveDict(self._singleProxyList, ProxyConfig.CONFIG_FILE, jsonFmt=True)
+        if orjson:
+            with open(ProxyConfig.CONFIG_FILE, 'wb') as fd:
+                fd.write(orjson.dumps(self._singleProxyList, option=orjson.OPT_INDENT_2))
+        else:
+            saveDict(self._singleProxyList, ProxyConfig.CONFIG_FILE, jsonFmt=True)
+        ProxyConfig._configCache[ProxyConfig.CONFIG_FILE] = (os.stat(ProxyConfig.CONFIG_FILE).st_mtime_ns, list(self._singleProxyList))
         self._info("Saved configuration.")
         
     def getProxyAttrList(self):
@@ -224,28 +285,124 @@ class ProxyConfig(object):
             elif response == 'q':
                 break
 
+class ProxyEndPoint(object):
+    """@brief Holds the state of one of the two sockets that make up a proxied connection."""
+
+    # Reading from the peer socket stops when this many bytes are queued to be sent to this socket.
+    TX_QUEUE_SIZE = 4 << 20
+
+    def __init__(self, sock):
+        """@brief Constructor
+           @param sock The non blocking socket for this end of the connection."""
+        self.sock = sock
+        self.peer = None
+        self.txQueue = deque()
+        self.txQueueByteCount = 0
+        self.txPipe = None
+        self.txPipeByteCount = 0
+        self.rxClosed = False
+        self.closed = False
+        self.connecting = False
+        self.events = 0
+
+    def openTxPipe(self, pipeSize):
+        """@brief Open the pipe that data is spliced through on its way to this socket.
+           @param pipeSize The requested pipe buffer size in bytes."""
+        # Only available on the platforms that support splice().
+        import fcntl
+
+        self.txPipe = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            fcntl.fcntl(self.txPipe[1], fcntl.F_SETPIPE_SZ, pipeSize)
+        except OSError:
+            # The size is limited by /proc/sys/fs/pipe-max-size, the default size still works.
+            pass
+
+    def isTxPending(self):
+        """@return True if data is waiting to be sent to this socket."""
+        return self.txPipeByteCount > 0 or self.txQueueByteCount > 0
+
+    def isTxFull(self):
+        """@return True if no more data should be read from the peer socket until
+                   some of the data waiting to be sent to this socket has been sent."""
+        return self.txPipeByteCount > 0 or self.txQueueByteCount >= ProxyEndPoint.TX_QUEUE_SIZE
+
+    def queueTxData(self, data):
+        """@brief Queue data to be sent to this socket.
+           @param data The bytes to send."""
+        self.txQueue.append(memoryview(data))
+        self.txQueueByteCount += len(data)
+
+    def dequeueTxData(self, byteCount):
+        """@brief Remove data that has been sent from the queue.
+           @param byteCount The number of bytes sent."""
+        self.txQueueByteCount -= byteCount
+        while byteCount > 0:
+            fragment = self.txQueue[0]
+            if len(fragment) > byteCount:
+                self.txQueue[0] = fragment[byteCount:]
+                break
+            byteCount -= len(fragment)
+            self.txQueue.popleft()
+
+    def close(self):
+        """@brief Close the socket and the pipe if open."""
+        if not self.closed:
+            self.sock.close()
+            if self.txPipe:
+                os.close(self.txPipe[0])
+                os.close(self.txPipe[1])
+            self.closed = True
+
 class TCPProxyServer(Thread):
 
-    def set(self, uio, attrList, backLog=5):
+    # On Linux data is moved between the sockets inside the kernel using splice()
+    USE_SPLICE = hasattr(os, "splice")
+    PIPE_SIZE = 1 << 20
+    SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+    SOCKET_BUFFER_SIZE = 4 << 20
+    # Queued data is sent with a single sendmsg() call of up to this many buffers where supported.
+    USE_SENDMSG = hasattr(socket.socket, "sendmsg")
+    MAX_SEND_FRAGMENTS = 64
+    # accept() errors caused by running out of file descriptors or memory. Accepting is paused
+    # for ACCEPT_PAUSE_SECONDS rather than stopping the server.
+    ACCEPT_RESOURCE_ERRNOS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+    ACCEPT_PAUSE_SECONDS = 0.5
+    # Used when the open file limit cannot be read.
+    DEFAULT_MAX_CONNECTIONS = 256
+
+    def set(self, uio, attrList, backLog=128, getSockAddr=None, maxConnections=None):
         """@brief Constructor.
-           @param attrList  A list of the attributes
+           @param attrList  A list of the attributes as returned by ProxyConfig.getProxyAttrList()
                   0 = The bind address
                   1 = The port to listen on
                   2 = The destintaion address
                   3 = The destination port.
-           @param backLog The number of client connections to handle simultainiously."""
+           @param backLog The number of pending client connections the kernel queues before they are accepted.
+           @param getSockAddr A function that returns the socket address for the destination
+                  address and port (E.G ProxyConfig.getSockAddr). If None the destination
+                  address is looked up on every connection. This is called from a resolver
+                  thread so that a slow lookup does not stop data being forwarded.
+           @param maxConnections The maximum number of simultaneous proxied connections.
+                  Further client connections are reset until a connection closes.
+                  If None the limit is derived from the open file limit (see getMaxConnections())."""
         self._uio = uio
         self._attrList = attrList
-        self._bindAddress = self._attrList[0]
-        if self._bindAddress.find("/") > 0:
-            self._bindAddress = self._bindAddress.split("/")[0]
-        self._listenPort  = self._attrList[1]
-        self._destAddress = self._attrList[2]
-        if self._destAddress.find("/") > 0:
-            self._destAddress = self._destAddress.split("/")[0]
-        self._destPort    = self._attrList[3]        
-        self._running = False
+        self._bindAddress, self._listenPort, self._destAddress, self._destPort = attrList
+        self._getSockAddr = getSockAddr or self._lookupSockAddr
+        # shutDown() and the resolver thread write to one of these sockets to wake the selector loop.
+        self._wakeupSockets = socket.socketpair()
+        for wakeupSocket in self._wakeupSockets:
+            wakeupSocket.setblocking(False)
+        self._shutDownRequested = False
+        # Client connections whose destination address lookup has completed.
+        self._resolvedQueue = deque()
         self._backLog = backLog
+        if maxConnections is None:
+            maxConnections = getMaxConnections()
+        self._maxConnections = maxConnections
+        self._acceptResumeTime = None
+        self._connectionCount = 0
 
     def _debug(self, msg):
         self._uio.debug(msg)
@@ -257,27 +414,64 @@ class TCPProxyServer(Thread):
         self._uio.error(msg)
     
     def shutDown(self):
-        """@brief Shutdown the server."""
-        self._running = False
+        """@brief Shutdown the server. All proxied connections are closed."""
+        self._shutDownRequested = True
+        self._wakeup()
+
+    def _wakeup(self):
+        """@brief Wake the selector loop. This may be called from any thread."""
+        try:
+            self._wakeupSockets[1].send(b"\0")
+        except OSError:
+            # If the socket buffer is full the loop has already been woken.
+            pass
 
     def run(self):
         self.serveConnection()
         
-    def serveConnection(self):
-        self._running = True        
-        listenPort=self._attrList[1]
+    def serveConnection(self, rxBufferSize=1 << 20):
+        """@brief Accept client connections and forward data in both directions for every
+                  connection from a single selector loop running in this thread.
+           @param rxBufferSize The size of the buffer that data is received into."""
         self._debug("Started server: Listen on TCP/IP port {}:{} and forward to {}:{}".format(self._bindAddress, self._listenPort, self._destAddress, self._destPort) )
+        self._selector = selectors.DefaultSelector()
+        self._resolver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tcpproxy-resolver")
+        self._rxView = memoryview(bytearray(rxBufferSize))
+        self._bufferSizeOptions = self._getBufferSizeOptions()
+        dock_socket = None
         try:
           try:
             dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             dock_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Accepted client sockets inherit the buffer sizes of the listening socket.
+            self._setBufferSizes(dock_socket)
             dock_socket.bind((self._bindAddress, self._listenPort))
-            while self._running:
-              dock_socket.listen(self._backLog)
-              while self._running:
-                  client_socket = dock_socket.accept()[0]
-                  server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                  self._handle_socket(client_socket, server_socket)
+            dock_socket.listen(self._backLog)
+            dock_socket.setblocking(False)
+            self._selector.register(dock_socket, selectors.EVENT_READ)
+            self._selector.register(self._wakeupSockets[0], selectors.EVENT_READ)
+            while True:
+                timeout = None
+                if self._acceptResumeTime is not None:
+                    timeout = max(0, self._acceptResumeTime - time())
+                    if timeout == 0:
+                        self._acceptResumeTime = None
+                        self._selector.register(dock_socket, selectors.EVENT_READ)
+                        timeout = None
+                for key, mask in self._selector.select(timeout):
+                    if key.data is not None:
+                        self._service(key.data, mask)
+                    elif key.fileobj is dock_socket:
+                        self._accept(dock_socket)
+                    else:
+                        try:
+                            self._wakeupSockets[0].recv(4096)
+                        except BlockingIOError:
+                            pass
+                        if self._shutDownRequested:
+                            return
+                        while self._resolvedQueue:
+                            self._connect(*self._resolvedQueue.popleft())
 
           except:
             self._uio.errorException()
@@ -285,30 +479,349 @@ class TCPProxyServer(Thread):
             #rather than spinning as fast as possible.
             sleep(0.25)
         finally:
+          # The listening socket is not registered while accepting is paused.
+          if dock_socket:
+              dock_socket.close()
+          for key in list(self._selector.get_map().values()):
+              if key.data is None:
+                  key.fileobj.close()
+              else:
+                  key.data.close()
+                  key.data.peer.close()
+          self._selector.close()
+          # Cancelling the pending lookups adds their client connections to the resolved queue.
+          self._resolver.shutdown(wait=False, cancel_futures=True)
+          while self._resolvedQueue:
+              self._resolvedQueue.popleft()[0].close()
+          self._wakeupSockets[0].close()
+          self._wakeupSockets[1].close()
           self._debug("Shutdown server listening on {}:{}".format(self._bindAddress, self._listenPort) )
 
-    def _handle_socket(self, client_socket, server_socket):
-      server_socket.connect((self._destAddress, self._destPort))
-      threadA = Thread(target=self._forward, args=(client_socket, server_socket))
-      threadA.start()
-
-      threadB = Thread(target=self._forward, args=(server_socket, client_socket))
-      threadB.start()
-     
-      self._info("Connected {}:{} to {}:{}".format(self._bindAddress, self._listenPort, self._destAddress, self._destPort))
-      
-    def _forward(self, source, destination, rxBufferSize=65536):
-        """@brief Forward the source socket data to the destination socket.
-           @param source Src socket.
-           @param destination Destination socket."""
-        data = None
+    def _accept(self, dock_socket):
+        """@brief Accept all the client connections waiting on the listening socket
+                  so that a burst of connections is handled from a single selector event.
+           @param dock_socket The listening socket."""
+        while True:
+            try:
+                client_socket = self._acceptClient(dock_socket)
+            except OSError as ex:
+                if ex.errno not in TCPProxyServer.ACCEPT_RESOURCE_ERRNOS:
+                    raise
+                # The connection stays queued by the kernel, so stop the selector reporting
+                # it until resources may have been released.
+                self._error("Failed to accept a connection on {}:{} ({}). Retrying in {} seconds.".format(self._bindAddress, self._listenPort, ex, TCPProxyServer.ACCEPT_PAUSE_SECONDS))
+                self._selector.unregister(dock_socket)
+                self._acceptResumeTime = time() + TCPProxyServer.ACCEPT_PAUSE_SECONDS
+                break
+            if client_socket is None:
+                break
+            if self._connectionCount >= self._maxConnections:
+                self._reject(client_socket)
+                continue
+            self._handle_socket(client_socket)
+
+    def _acceptClient(self, dock_socket):
+        """@brief Accept a single client connection. Where available accept4() is used so that
+                  the socket is created non blocking without a further system call.
+           @param dock_socket The listening socket.
+           @return The non blocking client socket or None if no connection is waiting."""
+        if _accept4:
+            flags = socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC
+            while True:
+                fd = _accept4(dock_socket.fileno(), None, None, flags)
+                if fd >= 0:
+                    # Passing the family, type and proto stops the socket module querying them.
+                    return socket.socket(dock_socket.family, socket.SOCK_STREAM | socket.SOCK_NONBLOCK, dock_socket.proto, fileno=fd)
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                if err not in (errno.EINTR, errno.ECONNABORTED):
+                    raise OSError(err, os.strerror(err))
+
         try:
-            while self._running:
-              data = source.recv(rxBufferSize)
-              if data:
-                  destination.sendall(data)
-        except:
-            self._info("Disconnected")
+            client_socket = dock_socket.accept()[0]
+        except BlockingIOError:
+            return None
+        client_socket.setblocking(False)
+        return client_socket
+
+    def _reject(self, client_socket):
+        """@brief Reset a client connection that is refused because the server is handling
+                  its maximum number of connections.
+           @param client_socket The accepted client socket."""
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        client_socket.close()
+        self._debug("Rejected connection to {}:{} ({} connections active)".format(self._bindAddress, self._listenPort, self._connectionCount))
+
+    def _getBufferSizeOptions(self):
+        """@brief Decide which kernel socket buffer sizes to set. Setting SO_RCVBUF or SO_SNDBUF
+                  turns off Linux TCP buffer auto tuning and the size is capped by
+                  net.core.rmem_max/wmem_max. Therefore a size is only set when the kernel
+                  allows it and it is larger than the auto tuning maximum.
+           @return A list of (socket option, size) tuples."""
+        bufferSizeOptions = []
+        for option, maxSizeFile, autoTuneFile in ((socket.SO_RCVBUF, "/proc/sys/net/core/rmem_max", "/proc/sys/net/ipv4/tcp_rmem"),
+                                                  (socket.SO_SNDBUF, "/proc/sys/net/core/wmem_max", "/proc/sys/net/ipv4/tcp_wmem")):
+            try:
+                with open(maxSizeFile) as fd:
+                    maxSize = int(fd.read())
+                with open(autoTuneFile) as fd:
+                    autoTuneMaxSize = int(fd.read().split()[2])
+            except (OSError, ValueError, IndexError):
+                # Without the kernel limits the buffer sizes are left to the OS.
+                continue
+            if autoTuneMaxSize < TCPProxyServer.SOCKET_BUFFER_SIZE <= maxSize:
+                bufferSizeOptions.append((option, TCPProxyServer.SOCKET_BUFFER_SIZE))
+        return bufferSizeOptions
+
+    def _setBufferSizes(self, sock):
+        """@brief Set the kernel socket buffer sizes chosen by _getBufferSizeOptions(). This must be
+                  done before a socket is connected or listening so that the TCP window scaling can
+                  use the larger buffers.
+           @param sock The socket to set the buffer sizes on."""
+        for option, size in self._bufferSizeOptions:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+    def _setConnectionOptions(self, sock):
+        """@brief Set the options for a connected socket. Nagle's algorithm is disabled so
+                  that small messages of interactive protocols are forwarded without delay.
+           @param sock The connected socket."""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def _lookupSockAddr(self, address, port):
+        """@brief Look up the socket address of the destination.
+           @param address The host name or IP address.
+           @param port The TCP port.
+           @return The socket address tuple."""
+        return socket.getaddrinfo(address, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+
+    def _handle_socket(self, client_socket):
+      """@brief Start proxying an accepted client connection. The destination address is
+                looked up by the resolver thread, after which _connect() is called.
+         @param client_socket The non blocking client socket."""
+      clientEndPoint = ProxyEndPoint(client_socket)
+      self._connectionCount += 1
+      future = self._resolver.submit(self._getSockAddr, self._destAddress, self._destPort)
+      future.add_done_callback(lambda future: self._resolved(clientEndPoint, future))
+
+    def _resolved(self, clientEndPoint, future):
+        """@brief Called from the resolver thread when a destination address lookup completes.
+           @param clientEndPoint The ProxyEndPoint instance of the client connection.
+           @param future The Future holding the socket address."""
+        self._resolvedQueue.append((clientEndPoint, future))
+        self._wakeup()
+
+    def _connect(self, clientEndPoint, future):
+        """@brief Start a non blocking connection to the destination. The connection
+                  completes when the selector reports the socket as writable.
+           @param clientEndPoint The ProxyEndPoint instance of the client connection.
+           @param future The Future holding the socket address."""
+        serverEndPoint = None
+        try:
+            sockAddr = future.result()
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            serverEndPoint = ProxyEndPoint(server_socket)
+            self._setBufferSizes(server_socket)
+            server_socket.setblocking(False)
+            err = server_socket.connect_ex(sockAddr)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise OSError(err, os.strerror(err))
+        except Exception as ex:
+            self._connectFailed(clientEndPoint, serverEndPoint, ex)
+            return
+
+        clientEndPoint.peer = serverEndPoint
+        serverEndPoint.peer = clientEndPoint
+        serverEndPoint.connecting = True
+        self._updateEvents(serverEndPoint)
+
+    def _connected(self, serverEndPoint):
+        """@brief Called when a connection to the destination has completed or failed.
+           @param serverEndPoint The ProxyEndPoint instance of the destination connection."""
+        clientEndPoint = serverEndPoint.peer
+        serverEndPoint.connecting = False
+        try:
+            err = serverEndPoint.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, os.strerror(err))
+            self._setConnectionOptions(clientEndPoint.sock)
+            self._setConnectionOptions(serverEndPoint.sock)
+            if TCPProxyServer.USE_SPLICE:
+                clientEndPoint.openTxPipe(TCPProxyServer.PIPE_SIZE)
+                serverEndPoint.openTxPipe(TCPProxyServer.PIPE_SIZE)
+        except OSError as ex:
+            self._connectFailed(clientEndPoint, serverEndPoint, ex)
+            return
+
+        self._updateEvents(clientEndPoint)
+        self._updateEvents(serverEndPoint)
+        self._info("Connected {}:{} to {}:{}".format(self._bindAddress, self._listenPort, self._destAddress, self._destPort))
+
+    def _connectFailed(self, clientEndPoint, serverEndPoint, ex):
+        """@brief Close a client connection because the destination could not be connected to.
+           @param clientEndPoint The ProxyEndPoint instance of the client connection.
+           @param serverEndPoint The ProxyEndPoint instance of the destination connection or None.
+           @param ex The exception that caused the failure."""
+        for endPoint in (clientEndPoint, serverEndPoint):
+            if endPoint:
+                self._closeEndPoint(endPoint)
+        self._connectionCount -= 1
+        self._error("Failed to connect to {}:{} ({})".format(self._destAddress, self._destPort, ex))
+
+    def _updateEvents(self, endPoint):
+        """@brief Register the events of interest for a socket with the selector.
+                  We stop reading from a socket while too much data received from it is
+                  waiting to be sent to its peer so that a slow receiver applies back pressure.
+           @param endPoint The ProxyEndPoint instance."""
+        events = 0
+        if endPoint.connecting:
+            events = selectors.EVENT_WRITE
+        elif not endPoint.peer.connecting:
+            if not endPoint.rxClosed and not endPoint.peer.isTxFull():
+                events |= selectors.EVENT_READ
+            if endPoint.isTxPending():
+                events |= selectors.EVENT_WRITE
+
+        if events != endPoint.events:
+            if endPoint.events == 0:
+                self._selector.register(endPoint.sock, events, endPoint)
+            elif events == 0:
+                self._selector.unregister(endPoint.sock)
+            else:
+                self._selector.modify(endPoint.sock, events, endPoint)
+            endPoint.events = events
+
+    def _service(self, endPoint, mask):
+        """@brief Service a socket that the selector reported as ready.
+           @param endPoint The ProxyEndPoint instance.
+           @param mask The selector events that are ready."""
+        if endPoint.connecting:
+            self._connected(endPoint)
+            return
+        if not endPoint.closed and mask & selectors.EVENT_WRITE:
+            self._flush(endPoint)
+        if not endPoint.closed and mask & selectors.EVENT_READ:
+            self._receive(endPoint)
+
+    def _receive(self, endPoint):
+        """@brief Read data from a socket and forward it to the peer socket.
+           @param endPoint The ProxyEndPoint instance to read from."""
+        peer = endPoint.peer
+        try:
+            if peer.txPipe:
+                rxByteCount = os.splice(endPoint.sock.fileno(), peer.txPipe[1], TCPProxyServer.PIPE_SIZE, flags=TCPProxyServer.SPLICE_FLAGS)
+            else:
+                rxByteCount = endPoint.sock.recv_into(self._rxView)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._disconnect(endPoint)
+            return
+
+        if rxByteCount == 0:
+            endPoint.rxClosed = True
+            if not peer.isTxPending():
+                self._shutdownTx(peer)
+            if not endPoint.closed:
+                self._updateEvents(endPoint)
+            return
+
+        if peer.txPipe:
+            peer.txPipeByteCount = rxByteCount
+            self._flush(peer)
+            return
+
+        # If data is already queued the new data is sent with it when the peer is writable.
+        txByteCount = 0
+        if not peer.isTxPending():
+            try:
+                txByteCount = peer.sock.send(self._rxView[:rxByteCount])
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._disconnect(endPoint)
+                return
+
+        if txByteCount < rxByteCount:
+            # The receive buffer is reused so the unsent data must be copied.
+            peer.queueTxData(bytes(self._rxView[txByteCount:rxByteCount]))
+            self._updateEvents(peer)
+            self._updateEvents(endPoint)
+
+    def _flush(self, endPoint):
+        """@brief Send data queued for a socket that could not be sent when it was received.
+           @param endPoint The ProxyEndPoint instance to send data to."""
+        try:
+            if endPoint.txPipe:
+                txByteCount = os.splice(endPoint.txPipe[0], endPoint.sock.fileno(), endPoint.txPipeByteCount, flags=TCPProxyServer.SPLICE_FLAGS)
+            elif TCPProxyServer.USE_SENDMSG:
+                txByteCount = endPoint.sock.sendmsg(islice(endPoint.txQueue, TCPProxyServer.MAX_SEND_FRAGMENTS))
+            else:
+                txByteCount = endPoint.sock.send(endPoint.txQueue[0])
+        except BlockingIOError:
+            txByteCount = 0
+        except OSError:
+            self._disconnect(endPoint)
+            return
+
+        if endPoint.txPipe:
+            endPoint.txPipeByteCount -= txByteCount
+        else:
+            endPoint.dequeueTxData(txByteCount)
+        if not endPoint.isTxPending() and endPoint.peer.rxClosed:
+            self._shutdownTx(endPoint)
+        if not endPoint.closed:
+            self._updateEvents(endPoint)
+            self._updateEvents(endPoint.peer)
+
+    def _shutdownTx(self, endPoint):
+        """@brief Pass on a half close to a socket once the data queued for it has been sent.
+                  The connection is closed when both directions have been closed.
+           @param endPoint The ProxyEndPoint instance to stop sending data to."""
+        if endPoint.rxClosed and not endPoint.peer.isTxPending():
+            self._disconnect(endPoint)
+        else:
+            try:
+                endPoint.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                self._disconnect(endPoint)
+
+    def _disconnect(self, endPoint):
+        """@brief Close both sockets of a proxied connection.
+           @param endPoint The ProxyEndPoint instance for either socket of the connection."""
+        self._closeEndPoint(endPoint)
+        self._closeEndPoint(endPoint.peer)
+        self._connectionCount -= 1
+        self._info("Disconnected")
+
+    def _closeEndPoint(self, endPoint):
+        """@brief Remove a socket from the selector and close it.
+           @param endPoint The ProxyEndPoint instance."""
+        if endPoint.events:
+            self._selector.unregister(endPoint.sock)
+            endPoint.events = 0
+        endPoint.close()
+
+def getMaxConnections(serverCount=1):
+    """@brief Get the number of simultaneous connections each proxy server can handle
+              without the process running out of file descriptors.
+       @param serverCount The number of proxy servers running in this process. Treated as 1 if less.
+       @return The maximum number of connections for each proxy server."""
+    try:
+        import resource
+        fdLimit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ImportError, OSError, ValueError):
+        return TCPProxyServer.DEFAULT_MAX_CONNECTIONS
+
+    if fdLimit == resource.RLIM_INFINITY:
+        return TCPProxyServer.DEFAULT_MAX_CONNECTIONS
+    # Each connection uses two sockets and, when splicing, two pipes. The listening socket,
+    # wakeup sockets and selector of each server and the process's other files are reserved.
+    fdsPerConnection = 6 if TCPProxyServer.USE_SPLICE else 2
+    serverCount = max(1, serverCount)
+    reservedFds = 16 + 4 * serverCount
+    return max(1, (fdLimit - reservedFds) // (fdsPerConnection * serverCount))
 
 class TCPProxy(object):
 
@@ -323,13 +836,14 @@ class TCPProxy(object):
     def serve(self):
         """@brief Server all TCP connections."""
         proxyAttrList = self._proxyConfig.getProxyAttrList()
+        maxConnections = getMaxConnections(len(proxyAttrList))
         for singleProxyAttr in proxyAttrList:
             self._uio.info("Forwarding {}:{} to {}:{}".format(singleProxyAttr[0],
                                                               singleProxyAttr[1],
                                                               singleProxyAttr[2],
                                                               singleProxyAttr[3]))
             tcpProxyServer = TCPProxyServer()
-            tcpProxyServer.set(self._uio, singleProxyAttr)
+            tcpProxyServer.set(self._uio, singleProxyAttr, getSockAddr=self._proxyConfig.getSockAddr, maxConnections=maxConnections)
             tcpProxyServer.start()
         # We rely on the TCP threads not being daemon threads to keep running as the main thread will exit from here
             
@@ -339,6 +853,7 @@ class TCPProxy(object):
 
     def enableAutoStart(self):
         """@brief Enable this program to auto start when the computer on which it is installed starts."""
+        from p3lib.boot_manager import BootManager
         bootManager = BootManager()
         if not self._options.user:
             raise Exception("--user not set.")
@@ -352,12 +867,14 @@ class TCPProxy(object):
         
     def disableAutoStart(self):
         """@brief Enable this program to auto start when the computer on which it is installed starts."""
+        from p3lib.boot_manager import BootManager
         bootManager = BootManager()
         bootManager.remove()
         self._uio.info("Disabled auto start")
 
     def checkAutoStartStatus(self):
         """@brief Check the status of a process previously set to auto start."""
+        from p3lib.boot_manager import BootManager
         bootManager = BootManager()
         lines = bootManager.getStatus()
         if lines and len(lines) > 0:
@@ -366,6 +883,8 @@ class TCPProxy(object):
                 
 def main():
     """@brief Program entry point"""
+    import argparse
+
     uio = UIO()
 
     try:
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from tcpproxy.tcpproxy import ProxyConfig
+
+class ScriptedUIO(object):
+    """@brief A UIO that returns scripted responses and records errors."""
+
+    def __init__(self, responses):
+        self._responses = list(responses)
+        self.errors = []
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+    def getInput(self, prompt):
+        return str(self._responses.pop(0))
+
+    def getIntInput(self, prompt):
+        return int(self._responses.pop(0))
+
+class ProxyConfigTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._tempDir = tempfile.TemporaryDirectory()
+        self._configFile = os.path.join(self._tempDir.name, "tcpproxy.cfg")
+        with open(self._configFile, 'w') as fd:
+            fd.write('[["0.0.0.0/32", 2222, "localhost", 22]]')
+        patcher = mock.patch.object(ProxyConfig, "CONFIG_FILE", self._configFile)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._tempDir.cleanup)
+
+    def test_load_normalises_rows(self):
+        proxyConfig = ProxyConfig(ScriptedUIO([]))
+        self.assertEqual(proxyConfig.getProxyAttrList(), [("0.0.0.0", 2222, "localhost", 22)])
+
+    def test_load_skips_invalid_rows(self):
+        # Older versions saved a null bind address if the user quit the bind address prompt.
+        with open(self._configFile, 'w') as fd:
+            fd.write('[["0.0.0.0/32", 2222, "localhost", 22], [null, 3333, "localhost", 22], ["0.0.0.0/32", 4444]]')
+        uio = ScriptedUIO([])
+        proxyConfig = ProxyConfig(uio)
+        self.assertEqual(proxyConfig.getProxyAttrList(), [("0.0.0.0", 2222, "localhost", 22)])
+        self.assertEqual(len(uio.errors), 2)
+
+    def test_edit_keeps_default_bind_address(self):
+        # Row 1, then press Enter to keep every value.
+        uio = ScriptedUIO([1, "", "", "", ""])
+        proxyConfig = ProxyConfig(uio)
+        proxyConfig._editProxy()
+        self.assertEqual(uio.errors, [])
+        self.assertEqual(proxyConfig.getProxyAttrList(), [("0.0.0.0", 2222, "localhost", 22)])
+
+    def test_add_accepts_listed_bind_address(self):
+        uio = ScriptedUIO([ProxyConfig.BIND_ALL_ADDRESS, 3333, "localhost", 22])
+        proxyConfig = ProxyConfig(uio)
+        proxyConfig._addProxy()
+        self.assertEqual(uio.errors, [])
+        self.assertEqual(proxyConfig.getProxyAttrList()[-1], ("0.0.0.0", 3333, "localhost", 22))
+
+    def test_sock_addr_cache_expires(self):
+        proxyConfig = ProxyConfig(ScriptedUIO([]))
+        addrInfo = [[(None, None, None, None, ("192.168.1.1", 22))], [(None, None, None, None, ("192.168.1.2", 22))]]
+        with mock.patch("socket.getaddrinfo", side_effect=addrInfo) as getaddrinfo, mock.patch("tcpproxy.tcpproxy.time") as timeNow:
+            timeNow.return_value = 1000
+            self.assertEqual(proxyConfig.getSockAddr("host", 22), ("192.168.1.1", 22))
+            self.assertEqual(proxyConfig.getSockAddr("host", 22), ("192.168.1.1", 22))
+            self.assertEqual(getaddrinfo.call_count, 1)
+            timeNow.return_value = 1000 + ProxyConfig.SOCK_ADDR_CACHE_SECONDS
+            self.assertEqual(proxyConfig.getSockAddr("host", 22), ("192.168.1.2", 22))
+
+    def test_table_lines_aligned(self):
+        infoMessages = []
+        uio = ScriptedUIO([])
+        uio.info = infoMessages.append
+        ProxyConfig(uio)._showProxyDict()
+        # The UIO prefix is only added to the first line so the table must start on the next one.
+        prefixLine, *lines = infoMessages[0].split("\n")
+        self.assertEqual(prefixLine, "")
+        self.assertEqual(len(lines), 5)
+        self.assertEqual({len(line) for line in lines}, {len(lines[0])})
@@ -0,0 +1,186 @@
+import os
+import errno
+import resource
+import socket
+import selectors
+import threading
+import time
+import unittest
+from unittest import mock
+
+from p3lib.uio import UIO
+
+from tcpproxy.tcpproxy import TCPProxyServer, getMaxConnections
+
+LOCALHOST = "127.0.0.1"
+TIMEOUT_SECONDS = 10
+
+def getFreePort():
+    """@brief Get a TCP port that is not in use on the loopback interface."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((LOCALHOST, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def recvAll(sock):
+    """@brief Read from a socket until the peer closes it.
+       @return The bytes received."""
+    data = bytearray()
+    while True:
+        rxData = sock.recv(1 << 16)
+        if not rxData:
+            return bytes(data)
+        data += rxData
+
+def waitFor(condition):
+    """@brief Wait for a condition to become True.
+       @return True if the condition became True before the timeout."""
+    stopTime = time.time() + TIMEOUT_SECONDS
+    while time.time() < stopTime:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+class ProxyTestCase(unittest.TestCase):
+    """@brief Runs a TCPProxyServer forwarding a loopback port to a destination listening socket."""
+
+    def setUp(self):
+        self._destSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._destSocket.bind((LOCALHOST, 0))
+        self._destSocket.listen(16)
+        self._destSocket.settimeout(TIMEOUT_SECONDS)
+        self._destPort = self._destSocket.getsockname()[1]
+        self._listenPort = getFreePort()
+        self._server = None
+
+    def tearDown(self):
+        if self._server:
+            self._server.shutDown()
+            self._server.join(TIMEOUT_SECONDS)
+            self.assertFalse(self._server.is_alive())
+        self._destSocket.close()
+
+    def _startServer(self, getSockAddr=None, destPort=None):
+        self._server = TCPProxyServer()
+        self._server.daemon = True
+        self._server.set(UIO(), (LOCALHOST, self._listenPort, LOCALHOST, destPort or self._destPort), getSockAddr=getSockAddr)
+        self._server.start()
+        self.assertTrue(waitFor(lambda: hasattr(self._server, "_selector") and len(self._server._selector.get_map()) >= 2))
+
+    def _connect(self):
+        """@brief Connect a client through the proxy.
+           @return A tuple containing the client socket and the socket accepted by the destination."""
+        client = socket.create_connection((LOCALHOST, self._listenPort), timeout=TIMEOUT_SECONDS)
+        dest = self._destSocket.accept()[0]
+        dest.settimeout(TIMEOUT_SECONDS)
+        return client, dest
+
+    def _getEndPoints(self):
+        return [key.data for key in list(self._server._selector.get_map().values()) if key.data is not None]
+
+    def test_half_close(self):
+        self._startServer()
+        client, dest = self._connect()
+        client.sendall(b"request")
+        client.shutdown(socket.SHUT_WR)
+        # The destination sees the data followed by EOF while the other direction stays open.
+        self.assertEqual(recvAll(dest), b"request")
+        dest.sendall(b"response")
+        dest.close()
+        self.assertEqual(recvAll(client), b"response")
+        client.close()
+        self.assertTrue(waitFor(lambda: self._server._connectionCount == 0))
+
+    def test_back_pressure(self):
+        self._startServer()
+        client, dest = self._connect()
+        payload = os.urandom(64 << 20)
+        sender = threading.Thread(target=client.sendall, args=(payload,), daemon=True)
+        sender.start()
+
+        # While the destination is not reading, the proxy must stop reading from the client.
+        # A socket that is neither read nor written is removed from the selector so check it via its peer.
+        def clientReadStopped():
+            return any(endPoint.isTxFull() and not endPoint.peer.events & selectors.EVENT_READ for endPoint in self._getEndPoints())
+        self.assertTrue(waitFor(clientReadStopped))
+
+        received = bytearray()
+        while len(received) < len(payload):
+            received += dest.recv(1 << 20)
+        sender.join(TIMEOUT_SECONDS)
+        self.assertEqual(bytes(received), payload)
+        client.close()
+        dest.close()
+
+    def test_slow_lookup_does_not_stall_connections(self):
+        lookupReleased = threading.Event()
+        lookupCount = []
+        def getSockAddr(address, port):
+            lookupCount.append(address)
+            if len(lookupCount) > 1:
+                lookupReleased.wait(TIMEOUT_SECONDS)
+            return (address, port)
+
+        self._startServer(getSockAddr=getSockAddr)
+        client, dest = self._connect()
+        slowClient = socket.create_connection((LOCALHOST, self._listenPort), timeout=TIMEOUT_SECONDS)
+        self.assertTrue(waitFor(lambda: len(lookupCount) == 2))
+
+        # The established connection keeps forwarding while the second lookup is blocked.
+        client.sendall(b"ping")
+        self.assertEqual(dest.recv(4), b"ping")
+        dest.sendall(b"pong")
+        self.assertEqual(client.recv(4), b"pong")
+
+        lookupReleased.set()
+        slowDest = self._destSocket.accept()[0]
+        for sock in (client, dest, slowClient, slowDest):
+            sock.close()
+
+    def test_connect_failure(self):
+        self._startServer(destPort=getFreePort())
+        client = socket.create_connection((LOCALHOST, self._listenPort), timeout=TIMEOUT_SECONDS)
+        self.assertEqual(recvAll(client), b"")
+        client.close()
+        self.assertTrue(waitFor(lambda: self._server._connectionCount == 0))
+        self.assertTrue(self._server.is_alive())
+
+    def test_accept_out_of_files(self):
+        acceptCount = []
+        acceptClient = TCPProxyServer._acceptClient
+        def failSecondAccept(server, dock_socket):
+            acceptCount.append(None)
+            if len(acceptCount) == 2:
+                raise OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+            return acceptClient(server, dock_socket)
+
+        with mock.patch.object(TCPProxyServer, "_acceptClient", failSecondAccept):
+            self._startServer()
+            client, dest = self._connect()
+            # The second connection is accepted once the listening socket is resumed.
+            secondClient, secondDest = self._connect()
+            self.assertTrue(self._server.is_alive())
+            for sock, peer in ((client, dest), (secondClient, secondDest)):
+                sock.sendall(b"ping")
+                self.assertEqual(peer.recv(4), b"ping")
+                sock.close()
+                peer.close()
+
+@mock.patch.object(TCPProxyServer, "USE_SPLICE", False)
+class UserspaceProxyTestCase(ProxyTestCase):
+    """@brief Run the same tests using the recv_into()/sendmsg() path rather than splice()."""
+
+class MaxConnectionsTestCase(unittest.TestCase):
+
+    def test_max_connections_from_file_limit(self):
+        with mock.patch.object(resource, "getrlimit", return_value=(1024, 4096)):
+            fdsPerConnection = 6 if TCPProxyServer.USE_SPLICE else 2
+            self.assertEqual(getMaxConnections(), (1024 - 20) // fdsPerConnection)
+            self.assertEqual(getMaxConnections(4), (1024 - 32) // (fdsPerConnection * 4))
+
+    def test_max_connections_without_servers(self):
+        # No proxy rows are configured, as on a fresh install.
+        with mock.patch.object(resource, "getrlimit", return_value=(1024, 4096)):
+            self.assertEqual(getMaxConnections(0), getMaxConnections(1))